@@ -1,17 +1,26 @@
 import random
 import math
+import os
+import warnings
 import numpy as np
 from operator import add
 from cvxopt import matrix, solvers
 solvers.options['show_progress'] = 0
 
 class BlottoLP:
+    # Strategy spaces listed in this process, keyed on (n_sol, n_bfs).
+    # At most strat_space_cache_size are kept, the oldest dropped first
+    strat_space_cache = {}
+    strat_space_cache_size = 32
+
     def __init__(self, n_sol_atk, n_sol_def, n_bfs):
         self.n_sol_attacker = n_sol_atk
         self.n_sol_defender = n_sol_def
         self.n_battlefields = n_bfs
         self.strat_space_A = None
         self.strat_space_D = None
+        # Both players share one strategy space when A == D
+        self.symmetric = (n_sol_atk == n_sol_def)
 
     def unique_depl_strats(self, depl_strat_list):
         '''Extract and return unique deplyment strategies'''
@@ -20,7 +29,7 @@ class BlottoLP:
         for idx, s in enumerate(strats):
             kidx = idx + 1
             while kidx < len(strats):
-                if set(s) == set(strats[kidx]):
+                if sorted(s) == sorted(strats[kidx]):
                     del strats[kidx]
                 else:
                     kidx += 1
@@ -75,6 +84,22 @@ class BlottoLP:
                 
         return strategies
 
+    def get_strat_space(self, n_sol, n_bfs):
+        '''
+        Cached strategy space of a player, listed by partition_space
+        so that every solver works on the same strategies in the same
+        order. The cache holds tuples and every call returns a fresh
+        copy of the strategies as lists
+        '''
+        cache = BlottoLP.strat_space_cache
+        key = (n_sol, n_bfs)
+        if key not in cache:
+            if len(cache) >= BlottoLP.strat_space_cache_size:
+                del cache[next(iter(cache))]
+            cache[key] = tuple(tuple(s) for s in self.partition_space(n_sol, n_bfs).tolist())
+
+        return [list(s) for s in cache[key]]
+
     def game_matrix(self):
         '''
         Creates a matrix for the Blotto Game with
@@ -88,12 +113,16 @@ class BlottoLP:
         B = self.n_battlefields
 
         # Getting the troop deployment strategies
-        self.strat_space_A = self.list_strat(A, B)
+        self.strat_space_A = self.get_strat_space(A, B)
         n_A_strats = len(self.strat_space_A)
 
+        if self.symmetric:
+            self.strat_space_D = self.strat_space_A
+            return self.symmetric_game_matrix(self.strat_space_A)
+
         #print(A_strats)
 
-        self.strat_space_D = self.list_strat(D, B)
+        self.strat_space_D = self.get_strat_space(D, B)
         n_D_strats = len(self.strat_space_D)
 
         #print(D_strats)
@@ -115,7 +144,32 @@ class BlottoLP:
         
         return np.array(gm_mtx)
 
-    def lp_opt_sol(self, gm_mtx, solver="glpk"):
+    def symmetric_game_matrix(self, strat_space, chunk_size=2**22):
+        '''
+        Creates the game matrix when both players share strat_space.
+        Only the upper triangle is compared: each comparison of a
+        block of rows with the columns from the diagonal onwards fills
+        both G[a, d] and G[d, a]; tied bases count for neither player
+        '''
+        strat_space = np.asarray(strat_space)
+        B = self.n_battlefields
+        n_strats = len(strat_space)
+
+        gm_mtx = np.zeros([n_strats, n_strats])
+        n_rows = max(1, chunk_size // max(1, n_strats * B * B))
+
+        for start in range(0, n_strats, n_rows):
+            stop = min(start + n_rows, n_strats)
+            strats_chunk = strat_space[start:stop, None, :, None]
+            strats_rest = strat_space[None, start:, None, :]
+            bfs_win_a = (strats_chunk > strats_rest).sum(axis=(2, 3))
+            bfs_win_d = (strats_chunk < strats_rest).sum(axis=(2, 3))
+            gm_mtx[start:stop, start:] = bfs_win_a / B
+            gm_mtx[start:, start:stop] = bfs_win_d.T / B
+
+        return gm_mtx
+
+    def lp_opt_sol(self, gm_mtx, solver="glpk", single_lp=None):
         '''
         Solves Linear Programs in the following form:
 
@@ -145,6 +199,11 @@ class BlottoLP:
         A_eq = [1,1,....,1,0]
         b_eq = 1
         b.T = [0,0,...., 0]
+
+        With single_lp (the default when A == D) only the attacker LP
+        is solved and the defender solution is derived from it. It then
+        holds only 'status', 'x', 'primal objective' and
+        'dual objective'; the other cvxopt fields are only in sol_A
         '''
 
         m_mtx, n_mtx = gm_mtx.shape
@@ -180,6 +239,25 @@ class BlottoLP:
         # solve the LP for Attacker
         sol_A = solvers.lp(c=f_A, G=A, h=b_A, A=A_eq, b=b_A_eq, solver=solver)
 
+        if single_lp is None:
+            single_lp = self.symmetric
+
+        if single_lp:
+            '''
+            The duals of the first n constraints of the attacker LP
+            are an optimal defender strategy and sum to 1, so the
+            defender LP is not solved again
+            '''
+            q = np.array(sol_A['z']).flatten()[:n_mtx]
+            w = np.array(sol_A['x']).flatten()[-1]
+            # The defender minimises w = v, the attacker minimises -v
+            sol_D = {'status': sol_A['status'],
+                     'x': matrix(np.append(q, w)),
+                     'primal objective': -sol_A['primal objective'],
+                     'dual objective': -sol_A['dual objective']}
+
+            return sol_A, sol_D
+
         '''Solving for defender'''
         # f.T denoted as f
         f_D = [0 for i in range(n_mtx)] + [1]
@@ -209,6 +287,171 @@ class BlottoLP:
 
         return sol_A, sol_D
 
+    @staticmethod
+    def partition_space(n_sol, n_bfs):
+        '''
+        Lists all the troop deployment strategies of a player where
+          no of troops = n_sol
+          no of bases = n_bfs
+
+        The strategies are returned as the rows of an array, each
+        strategy sorted in descending order
+        '''
+        def partitions(n, k, cap):
+            if k == 1:
+                return [[n]] if n <= cap else []
+
+            strats = []
+            for first in range(min(n, cap), math.ceil(n / k) - 1, -1):
+                for rest in partitions(n - first, k - 1, first):
+                    strats.append([first] + rest)
+
+            return strats
+
+        strats = partitions(n_sol, n_bfs, n_sol)
+
+        return np.array(strats, dtype="int64").reshape(-1, n_bfs)
+
+    @staticmethod
+    def payoff_matrix(strats_A, strats_D, n_bfs, chunk_size=2**22):
+        '''
+        Vectorised version of game_matrix for arbitrary lists of
+        attacker and defender strategies over n_bfs bases. Rows of the
+        attacker list are processed in chunks so that the intermediate
+        comparison array holds at most chunk_size entries
+        '''
+        strats_A = np.asarray(strats_A)
+        strats_D = np.asarray(strats_D)
+        B = n_bfs
+        n_A_strats = len(strats_A)
+        n_D_strats = len(strats_D)
+
+        gm_mtx = np.zeros([n_A_strats, n_D_strats])
+        n_rows = max(1, chunk_size // max(1, n_D_strats * B * B))
+
+        for start in range(0, n_A_strats, n_rows):
+            strats_chunk = strats_A[start:start + n_rows]
+            bfs_win = strats_chunk[:, None, :, None] > strats_D[None, :, None, :]
+            gm_mtx[start:start + n_rows] = bfs_win.sum(axis=(2, 3)) / B
+
+        return gm_mtx
+
+    def resolution_mask(self, strats, res):
+        '''
+        Marks the strategies that count troops in blocks of res soldiers,
+        i.e. every base other than the largest holds a multiple of res
+        troops and the largest base takes the remainder
+        '''
+        return np.all(strats[:, 1:] % res == 0, axis=1)
+
+    def neighbour_strats(self, strats, centres, radius, res):
+        '''
+        Indices of the strategies at resolution res which are within
+        radius troops on every base of at least one of the centres
+        '''
+        near = np.zeros(len(strats), dtype=bool)
+        for centre in centres:
+            near |= np.abs(strats - centre).max(axis=1) <= radius
+
+        return np.flatnonzero(near & self.resolution_mask(strats, res))
+
+    def multires_opt_sol(self, block=8, tol=1e-6, solver="glpk", max_iter=50, n_add=10, supp_tol=1e-9):
+        '''
+        Coarse-to-fine solution of the Blotto Game
+
+        The game is first solved with troops counted in blocks of
+        block soldiers. The block size is then halved and the game is
+        solved again only over the strategies within one old block of
+        the current support, until unit resolution is reached.
+
+        After every solve the restricted mixed strategies are checked
+        against best responses over the complete strategy spaces:
+            lower = min_{d} p.T @ G[:, d]
+            upper = max_{a} G[a, :] @ q
+        The iteration stops once upper - lower <= tol. At unit
+        resolution the n_add best responses of each player are added
+        to the restricted game until the gap closes.
+
+        Returns the solution vectors in the same layout as the 'x'
+        entries of lp_opt_sol, indexed by strat_space_A / strat_space_D.
+        multires_converged is False, and a warning is issued, if the gap
+        is still above tol after max_iter solves
+        '''
+        A = self.n_sol_attacker
+        D = self.n_sol_defender
+        B = self.n_battlefields
+
+        self.strat_space_A = self.get_strat_space(A, B)
+        self.strat_space_D = self.get_strat_space(D, B)
+        full_A = np.array(self.strat_space_A, dtype="int64").reshape(-1, B)
+        full_D = np.array(self.strat_space_D, dtype="int64").reshape(-1, B)
+        self.multires_history = []
+        self.multires_converged = False
+
+        res = max(1, int(block))
+        cand_A = np.flatnonzero(self.resolution_mask(full_A, res))
+        cand_D = np.flatnonzero(self.resolution_mask(full_D, res))
+
+        for it in range(max_iter):
+            gm_mtx = self.payoff_matrix(full_A[cand_A], full_D[cand_D], B)
+            sol_A, sol_D = self.lp_opt_sol(gm_mtx, solver=solver)
+            x_A = np.array(sol_A['x']).flatten()
+            x_D = np.array(sol_D['x']).flatten()
+            p = x_A[:-1]
+            q = x_D[:-1]
+            solved_A = cand_A
+            solved_D = cand_D
+
+            supp_A = cand_A[p > supp_tol]
+            supp_D = cand_D[q > supp_tol]
+
+            # Payoff of every pure strategy against the restricted mixes,
+            # renormalised over their supports so the bounds are certified
+            p_supp = p[p > supp_tol] / p[p > supp_tol].sum()
+            q_supp = q[q > supp_tol] / q[q > supp_tol].sum()
+            payoffs_A = self.payoff_matrix(full_A, full_D[supp_D], B) @ q_supp
+            payoffs_D = p_supp @ self.payoff_matrix(full_A[supp_A], full_D, B)
+            lower = payoffs_D.min()
+            upper = payoffs_A.max()
+
+            self.multires_history.append({'resolution': res,
+                                          'n_A_strats': len(cand_A),
+                                          'n_D_strats': len(cand_D),
+                                          'lower': lower,
+                                          'upper': upper})
+
+            if upper - lower <= tol:
+                self.multires_converged = True
+                break
+
+            # Best responses join the restricted game at every resolution
+            best_A = np.argsort(payoffs_A)[::-1][:n_add]
+            best_D = np.argsort(payoffs_D)[:n_add]
+
+            if res > 1:
+                radius = res
+                res = max(1, res // 2)
+                cand_A = self.neighbour_strats(full_A, full_A[supp_A], radius, res)
+                cand_D = self.neighbour_strats(full_D, full_D[supp_D], radius, res)
+                cand_A = np.union1d(cand_A, supp_A)
+                cand_D = np.union1d(cand_D, supp_D)
+
+            cand_A = np.union1d(cand_A, best_A)
+            cand_D = np.union1d(cand_D, best_D)
+
+        if not self.multires_converged:
+            warnings.warn("multires_opt_sol stopped after {} iterations with a gap of {} > tol".format(max_iter, upper - lower))
+
+        opt_A = np.zeros(len(full_A) + 1)
+        opt_A[solved_A] = p
+        opt_A[-1] = x_A[-1]
+
+        opt_D = np.zeros(len(full_D) + 1)
+        opt_D[solved_D] = q
+        opt_D[-1] = x_D[-1]
+
+        return opt_A, opt_D
+
     def get_best_strats(self, strat_probs, n, plr_type='attacker'):
         strat_probs = np.array(strat_probs).flatten()[:-1]
         #print(strat_probs)
@@ -249,7 +492,7 @@ class BlottoLP:
             print(row_format_data.format("Strategy " + str(idx + 1), *strat))
             print(row_format_u.format(*(["-"*15]*(self.n_battlefields + 1))))
 
-    def save_bestNstrats2csv(self, best_n_strats, plr_type='attacker'):
+    def save_bestNstrats2csv(self, best_n_strats, plr_type='attacker', out_dir='.'):
         headers = ["Battlefield " + str(i) for i in range(1, self.n_battlefields + 1)]
 
         if plr_type == 'attacker':
@@ -257,6 +500,7 @@ class BlottoLP:
         else:
             out_report_fname = 'best_defender_strats_bfs_' + str(self.n_battlefields) + '_atk_' + str(self.n_sol_attacker) + '_def_' + str(self.n_sol_defender) + '.csv'
 
+        out_report_fname = os.path.join(out_dir, out_report_fname)
         print("Writing to {}".format(out_report_fname))
         with open(out_report_fname, 'w') as out_f:
             out_f.write("{}\n".format(','.join([""] + headers)))
@@ -364,34 +608,34 @@ class BlottoPayoffTable:
                     out_f.write("{}\n".format(','.join([a] + row)))
 
 
-game_lp = BlottoLP(100,100,3)
-
-gm_mtx = game_lp.game_matrix()
-#print(gm_mtx)
-
-opt_A, opt_D = game_lp.lp_opt_sol(gm_mtx)
-# print('Attacker Optimal')
-# print(np.array(opt_A['x']).shape)
-# print(np.array(opt_A['x']).flatten().shape)
-# print(np.array(opt_A['x']).flatten()[:-1])
-# print('Defender Optimal')
-# print(opt_D['x'])
-
-#print('Best 30 Strategies for Attacker')
-#best_strats_A = game_lp.get_best_strats(opt_A['x'], 30, plr_type='attacker')
-#game_lp.disp_best_n_strats(best_strats_A)
-#game_lp.save_bestNstrats2csv(best_strats_A)
-# print(best_strats_A)
-
-print('Best 30 Strategies for Defender')
-best_strats_D = game_lp.get_best_strats(opt_D['x'], 30, plr_type='defender')
-game_lp.save_bestNstrats2csv(best_strats_D, plr_type='defender')
-# print(best_strats_D)
-
-# blotto_tbl = BlottoPayoffTable()
-# payoff_mtx = blotto_tbl.gen_blotto_table()
-#blotto_tbl.disp_payoff_table(payoff_mtx)
-# blotto_tbl.save_mtx2csv(payoff_mtx)
-
-
-
+if __name__ == "__main__":
+    game_lp = BlottoLP(100,100,3)
+
+    gm_mtx = game_lp.game_matrix()
+    #print(gm_mtx)
+
+    opt_A, opt_D = game_lp.lp_opt_sol(gm_mtx)
+    # Coarse-to-fine alternative to game_matrix + lp_opt_sol
+    # opt_A, opt_D = game_lp.multires_opt_sol(block=8)
+    # print('Attacker Optimal')
+    # print(np.array(opt_A['x']).shape)
+    # print(np.array(opt_A['x']).flatten().shape)
+    # print(np.array(opt_A['x']).flatten()[:-1])
+    # print('Defender Optimal')
+    # print(opt_D['x'])
+
+    #print('Best 30 Strategies for Attacker')
+    #best_strats_A = game_lp.get_best_strats(opt_A['x'], 30, plr_type='attacker')
+    #game_lp.disp_best_n_strats(best_strats_A)
+    #game_lp.save_bestNstrats2csv(best_strats_A)
+    # print(best_strats_A)
+
+    print('Best 30 Strategies for Defender')
+    best_strats_D = game_lp.get_best_strats(opt_D['x'], 30, plr_type='defender')
+    game_lp.save_bestNstrats2csv(best_strats_D, plr_type='defender')
+    # print(best_strats_D)
+
+    # blotto_tbl = BlottoPayoffTable()
+    # payoff_mtx = blotto_tbl.gen_blotto_table()
+    #blotto_tbl.disp_payoff_table(payoff_mtx)
+    # blotto_tbl.save_mtx2csv(payoff_mtx)
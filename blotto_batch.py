@@ -0,0 +1,364 @@
+# Batch runner for Blotto scenarios
+#
+# Reads a csv scenario file with one job per row:
+#
+#   kind,attackers,defenders,battlefields
+#   lp,100,100,3
+#   lp,30,25,4
+#   ev,100,,3
+#
+# kind "lp" solves the game with BlottoLP, kind "ev" trains an AttackerBot
+# on a Blotto game (defenders is ignored, both players have attackers
+# soldiers). Identical jobs are run once and strategy spaces shared by
+# several jobs are listed once. Jobs are run longest predicted time first,
+# each in its own process, while the predicted memory of the running jobs
+# stays within a budget, and are stopped after a timeout. Results are
+# written to an output directory as soon as each job finishes.
+
+import csv
+import os
+import sys
+import time
+import multiprocessing as mp
+from multiprocessing.connection import wait as mp_wait
+
+from BlottoLP import BlottoLP
+from blotto_evolutionary import Blotto, AttackerBot
+
+KINDS = ("lp", "ev")
+
+# Seconds per cost unit of estimate_cost for each kind of job, used to
+# compare the costs of different kinds. Tune them with the rates fitted
+# by report_costs
+SECONDS_PER_UNIT = {"lp": 1e-6, "ev": 5e-8}
+
+
+def load_scenarios(scenario_file):
+    '''
+    Reads the jobs in a scenario file as (kind, A, D, B) tuples,
+    skipping the header and blank lines. Raises ValueError on a
+    job of unknown kind or without battlefields
+    '''
+    scenarios = []
+    with open(scenario_file, "r") as f:
+        for line_no, rec in enumerate(csv.reader(f, delimiter=','), 1):
+            rec = [v.strip() for v in rec]
+            if len(rec) < 4 or not rec[1].isdigit():
+                continue
+            kind = rec[0].lower()
+            if kind not in KINDS:
+                raise ValueError("{}:{}: unknown job kind '{}', expected one of {}".format(
+                    scenario_file, line_no, rec[0], ", ".join(KINDS)))
+            n_sol_atk = int(rec[1])
+            n_sol_def = int(rec[2]) if rec[2] else n_sol_atk
+            n_bfs = int(rec[3])
+            if n_bfs < 1:
+                raise ValueError("{}:{}: a job needs at least one battlefield".format(scenario_file, line_no))
+            scenarios.append((kind, n_sol_atk, n_sol_def, n_bfs))
+
+    return scenarios
+
+
+def job_key(scenario):
+    '''Scenarios with the same key solve the same problem'''
+    kind, n_sol_atk, n_sol_def, n_bfs = scenario
+    if kind == "ev":
+        return (kind, n_sol_atk, n_sol_atk, n_bfs)
+    return (kind, n_sol_atk, n_sol_def, n_bfs)
+
+
+def partition_count(n_sol, n_bfs):
+    '''
+    Number of troop deployment strategies in BlottoLP, i.e. the
+    partitions of n_sol into at most n_bfs parts
+    '''
+    # ways[n] = partitions of n into parts of size at most k,
+    # which equals the partitions of n into at most k parts
+    ways = [1] + [0] * n_sol
+    for k in range(1, n_bfs + 1):
+        for n in range(k, n_sol + 1):
+            ways[n] += ways[n - k]
+
+    return ways[n_sol]
+
+
+def composition_count(n_sol, n_bfs):
+    '''Number of strategies in Blotto, see Blotto.compute_strategy_space_size'''
+    ways = 1
+    for i in range(1, n_bfs):
+        ways = ways * (n_sol + i) // i
+
+    return ways
+
+
+def estimate_cost(scenario):
+    '''
+    Predicted cost and memory of a job.
+
+    lp: game_matrix compares B * B troop counts for every pair of
+        strategies, in Python when A != D and about 60 times faster
+        with numpy when A == D; a Python comparison costs about a
+        quarter of a unit. Each LP grows with n_A * n_D * (n_A + n_D)
+        and holds a dense constraint matrix of (n_A + n_D + 1) x (n + 1)
+        doubles. The strategy spaces are listed by run_batch
+    ev: each epoch scores every learning strategy with an O(B^2 n) count,
+        and at most one epoch is needed per batch of unseen compositions
+
+    Costs are in units that differ between kinds, see predict_seconds
+    '''
+    kind, n_sol_atk, n_sol_def, n_bfs = job_key(scenario)
+
+    if kind == "lp":
+        n_A = partition_count(n_sol_atk, n_bfs)
+        n_D = partition_count(n_sol_def, n_bfs)
+        n_comparisons = n_A * n_D * n_bfs * n_bfs
+        if n_sol_atk == n_sol_def:
+            n_lps = 1
+            cost = n_comparisons // 240
+        else:
+            n_lps = 2
+            cost = n_comparisons // 4
+        cost += n_lps * n_A * n_D * (n_A + n_D) // 2000
+        memory = 8 * (n_A * n_D + n_lps * (n_A + n_D + 1) * (max(n_A, n_D) + 1))
+    else:
+        n_strats = composition_count(n_sol_atk, n_bfs)
+        n_learning = 60
+        n_epochs = min(1000, n_strats // (n_learning // 2) + 1)
+        cost = n_epochs * n_learning * n_bfs * n_bfs * n_sol_atk
+        memory = 200 * min(n_strats, 100000) + 8 * n_bfs * n_bfs * n_sol_atk
+
+    return cost, memory
+
+
+def predict_seconds(cost, kind, seconds_per_unit=SECONDS_PER_UNIT):
+    '''Converts a cost from estimate_cost to seconds'''
+    return cost * seconds_per_unit[kind]
+
+
+def job_spaces(scenario):
+    '''The (n_sol, n_bfs) strategy spaces an lp job needs'''
+    kind, n_sol_atk, n_sol_def, n_bfs = job_key(scenario)
+    if kind != "lp":
+        return []
+    return sorted(set([(n_sol_atk, n_bfs), (n_sol_def, n_bfs)]))
+
+
+def run_job(scenario, strat_spaces=None, top_n=30):
+    '''
+    Runs a single job. strat_spaces maps (n_sol, n_bfs) to strategy
+    spaces already listed by the caller, which the job uses instead
+    of listing them again
+    '''
+    kind, n_sol_atk, n_sol_def, n_bfs = job_key(scenario)
+    start_time = time.time()
+
+    if kind == "lp":
+        if strat_spaces:
+            BlottoLP.strat_space_cache.update(strat_spaces)
+        game = BlottoLP(n_sol_atk, n_sol_def, n_bfs)
+        gm_mtx = game.game_matrix()
+        opt_A, opt_D = game.lp_opt_sol(gm_mtx)
+        result = {'payoff': game.get_payoff(opt_A['x'], opt_D['x']),
+                  'best_A': game.get_best_strats(opt_A['x'], top_n, plr_type='attacker').tolist(),
+                  'best_D': game.get_best_strats(opt_D['x'], top_n, plr_type='defender').tolist()}
+    else:
+        game = Blotto(n_sol_atk, n_bfs)
+        attacker_bot = AttackerBot(game, 60)
+        l_final_strategies = attacker_bot.train(max_epochs=1000,
+                                                top_k=10,
+                                                patience=100,
+                                                log_every=0)
+        result = {'payoff': game.get_strategy_score(l_final_strategies[0]) / game.strategy_space_size,
+                  'best_A': l_final_strategies[:top_n]}
+
+    result['seconds'] = time.time() - start_time
+
+    return result
+
+
+def job_process(scenario, strat_spaces, conn):
+    '''Runs a job in its own process and sends back its status and result'''
+    try:
+        conn.send(("ok", run_job(scenario, strat_spaces)))
+    except Exception as e:
+        conn.send(("failed: {!r}".format(e), None))
+    finally:
+        conn.close()
+
+
+def save_result(scenario, result, output_dir):
+    '''Writes the best strategies of a finished job to its csv files'''
+    kind, n_sol_atk, n_sol_def, n_bfs = job_key(scenario)
+
+    if kind == "lp":
+        game = BlottoLP(n_sol_atk, n_sol_def, n_bfs)
+        game.save_bestNstrats2csv(result['best_A'], plr_type='attacker', out_dir=output_dir)
+        game.save_bestNstrats2csv(result['best_D'], plr_type='defender', out_dir=output_dir)
+    else:
+        csv_file = "best_ev_strategies_{}_{}_{}.csv".format(n_sol_atk, n_sol_atk, n_bfs)
+        csv_file = os.path.join(output_dir, csv_file)
+        print("Writing to {}".format(csv_file))
+        with open(csv_file, "w") as output:
+            writer = csv.writer(output, lineterminator='\n')
+            writer.writerows(result['best_A'])
+
+
+def run_batch(scenarios, output_dir="batch_output", results_file="batch_results.csv",
+              n_workers=4, memory_budget=2**31, seconds_per_unit=SECONDS_PER_UNIT,
+              timeout_factor=10, min_timeout=60):
+    '''
+    Runs the unique jobs among scenarios, longest predicted time first,
+    each in its own process with at most n_workers running at once. A
+    job is only started while the predicted memory of the running jobs,
+    including it, fits in memory_budget (a job is always started when
+    nothing else is running).
+
+    Strategy spaces shared by several lp jobs are listed once here and
+    handed to every job that needs them.
+
+    Every finished job is appended to results_file in output_dir straight
+    away and its strategies are saved there. A job that raises, dies, or
+    runs longer than max(timeout_factor * predicted seconds, min_timeout)
+    is stopped and recorded as failed, and the other jobs carry on.
+    Returns the rows of results_file
+    '''
+    jobs = {}
+    n_duplicates = {}
+    for scenario in scenarios:
+        key = job_key(scenario)
+        if key in jobs:
+            n_duplicates[key] += 1
+        else:
+            cost, memory = estimate_cost(key)
+            jobs[key] = (cost, memory, predict_seconds(cost, key[0], seconds_per_unit))
+            n_duplicates[key] = 0
+
+    # List every strategy space once, however many jobs use it
+    space_users = {}
+    for key in jobs:
+        for space in job_spaces(key):
+            space_users.setdefault(space, []).append(key)
+    strat_spaces = {}
+    for n_sol, n_bfs in space_users:
+        strats = BlottoLP.partition_space(n_sol, n_bfs).tolist()
+        strat_spaces[(n_sol, n_bfs)] = tuple(tuple(s) for s in strats)
+
+    # Longest predicted time first
+    pending = sorted(jobs, key=lambda key: jobs[key][2], reverse=True)
+    print("Scenarios: {}, Unique Jobs: {}, Strategy Spaces: {}".format(
+        len(scenarios), len(pending), len(strat_spaces)))
+
+    os.makedirs(output_dir, exist_ok=True)
+    headers = ["kind", "attackers", "defenders", "battlefields", "status", "payoff",
+               "predicted_cost", "predicted_memory", "predicted_seconds", "seconds"]
+    rows = []
+    with open(os.path.join(output_dir, results_file), "w") as out_f:
+        writer = csv.writer(out_f, lineterminator='\n')
+        writer.writerow(headers)
+
+        def record(key, status, result):
+            if status == "ok":
+                row = list(key) + [status, result['payoff'], jobs[key][0], jobs[key][1], jobs[key][2], result['seconds']]
+                save_result(key, result, output_dir)
+            else:
+                print("Job {} {}".format(key, status))
+                row = list(key) + [status, "", jobs[key][0], jobs[key][1], jobs[key][2], ""]
+            writer.writerow(row)
+            out_f.flush()
+            rows.append(row)
+
+        # conn -> (key, process, deadline)
+        running = {}
+        memory_in_use = 0
+        while pending or running:
+            # Start the longest pending jobs that fit in the budget
+            for key in list(pending):
+                if len(running) >= n_workers:
+                    break
+                memory = jobs[key][1]
+                if running and memory_in_use + memory > memory_budget:
+                    continue
+                spaces = dict((space, strat_spaces[space]) for space in job_spaces(key))
+                recv_conn, send_conn = mp.Pipe(duplex=False)
+                process = mp.Process(target=job_process, args=(key, spaces, send_conn))
+                process.start()
+                send_conn.close()
+                timeout = max(timeout_factor * jobs[key][2], min_timeout)
+                running[recv_conn] = (key, process, time.time() + timeout, timeout)
+                memory_in_use += memory
+                pending.remove(key)
+
+            next_deadline = min(deadline for key, process, deadline, timeout in running.values())
+            ready = mp_wait(list(running), timeout=max(next_deadline - time.time(), 0))
+
+            for conn in list(running):
+                key, process, deadline, timeout = running[conn]
+                if conn in ready:
+                    try:
+                        status, result = conn.recv()
+                    except EOFError:
+                        process.join()
+                        status, result = "failed: exited with code {}".format(process.exitcode), None
+                elif time.time() >= deadline:
+                    process.terminate()
+                    status, result = "failed: timed out after {:.0f}s".format(timeout), None
+                else:
+                    continue
+
+                process.join()
+                conn.close()
+                del running[conn]
+                memory_in_use -= jobs[key][1]
+                record(key, status, result)
+
+    report_costs(rows, n_duplicates, space_users)
+
+    return rows
+
+
+def report_costs(rows, n_duplicates, space_users):
+    '''
+    Prints the predicted against the actual time of every finished job,
+    the seconds per cost unit fitted over the jobs of each kind, to be
+    used as SECONDS_PER_UNIT, and the strategy spaces shared by jobs
+    '''
+    ok_rows = [row for row in rows if row[4] == "ok"]
+
+    print("\n\n======================================================================================")
+    print("Predicted vs Actual Cost")
+    print("======================================================================================\n\n")
+    row_format_header = "{:>15}|" * 7
+    row_format_data = "{:>15}|" * 4 + "{:>15.4f}|" * 2 + "{:>15}|"
+    print(row_format_header.format("Job", "Duplicates", "Shared Spaces", "Cost", "Predicted (s)", "Actual (s)", "Actual/Pred"))
+    for row in sorted(ok_rows, key=lambda row: row[8], reverse=True):
+        key = tuple(row[:4])
+        n_shared = len([space for space in job_spaces(key) if len(space_users[space]) > 1])
+        ratio = "{:.3f}".format(row[9] / row[8]) if row[8] else "-"
+        job = "{} {}/{}/{}".format(*key)
+        print(row_format_data.format(job, n_duplicates[key], n_shared, row[6], row[8], row[9], ratio))
+
+    for row in rows:
+        if row[4] != "ok":
+            print("{} {}/{}/{}: {}".format(*row[:5]))
+
+    for space, users in sorted(space_users.items()):
+        if len(users) > 1:
+            print("Strategy space of {} troops on {} bases listed once for {} jobs".format(space[0], space[1], len(users)))
+
+    for kind in sorted(set(row[0] for row in ok_rows)):
+        kind_rows = [row for row in ok_rows if row[0] == kind]
+        total_cost = sum(row[6] for row in kind_rows)
+        total_seconds = sum(row[9] for row in kind_rows)
+        if total_cost:
+            print("{}: {:.3e} seconds per cost unit".format(kind, total_seconds / total_cost))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        scenario_file = sys.argv[1]
+    else:
+        print("Input the Scenario File")
+        scenario_file = input("[User]: ")
+
+    scenarios = load_scenarios(scenario_file)
+    run_batch(scenarios)
@@ -20,8 +20,10 @@
 
 import random
 import csv
+import math
+import time
 import operator as op
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from functools import reduce
 
 
@@ -85,16 +87,36 @@ def create_unique_strategy(n_soldiers,
     return strategy
 
 
+def composition_rank(strategy):
+    # Index of a strategy among all the strategies with the same number of
+    # soldiers and battlefields: the positions of the bars in its
+    # stars-and-bars layout, ranked in the combinatorial number system
+    rank = 0
+    position = -1
+    for k, value in enumerate(strategy[:-1], 1):
+        position += value + 1
+        rank += math.comb(position, k)
+    return rank
+
+
 class Blotto:
     def __init__(self,
                  n_sol,
-                 n_bfs):
+                 n_bfs,
+                 exact_scoring=True):
         """ Set the number of soldiers available and the number of battlefields """
         self.n_soldiers = int(n_sol)
         self.n_battlefields = int(n_bfs)
         self.master_dataset = []
         self.unique_strategies = defaultdict(list)
-        self.strategy_space_size = min(self.compute_strategy_space_size(), 10000)
+        # Exact scoring counts wins against the entire composition space,
+        # otherwise strategies are scored against a sampled master dataset
+        self.exact_scoring = exact_scoring
+        self.win_counts = {}
+        if self.exact_scoring:
+            self.strategy_space_size = self.compute_strategy_space_size()
+        else:
+            self.strategy_space_size = min(self.compute_strategy_space_size(), 10000)
         print("#Soldiers : {}".format(self.n_soldiers))
         print("#Battlefields : {}".format(self.n_battlefields))
 
@@ -134,10 +156,53 @@ class Blotto:
                 player_2_score += 1
         return player_1_score, player_2_score
 
+    def count_wins(self,
+                   pl_strategy):
+        # Counts the compositions of n_soldiers over n_battlefields that
+        # pl_strategy beats, without enumerating the composition space.
+        #
+        # ways[t][w] = number of ways to deploy t soldiers over the
+        # battlefields seen so far such that pl_strategy wins w of them.
+        # On a battlefield with s soldiers the opponent loses with any of
+        # 0..s-1 soldiers and wins with s or more, so both transitions are
+        # range sums over ways[.][w] and are read off prefix sums.
+        #
+        # The count does not depend on the battlefield order, hence the
+        # results are cached on the sorted strategy.
+        key = tuple(sorted(pl_strategy))
+        if key in self.win_counts:
+            return self.win_counts[key]
+
+        n = self.n_soldiers
+        B = self.n_battlefields
+        ways = [[0] * (B + 1) for t in range(n + 1)]
+        ways[0][0] = 1
+        for bfs, s in enumerate(key):
+            prefix = [[0] * (B + 1) for t in range(n + 2)]
+            for t in range(n + 1):
+                for w in range(bfs + 1):
+                    prefix[t + 1][w] = prefix[t][w] + ways[t][w]
+            new_ways = [[0] * (B + 1) for t in range(n + 1)]
+            for t in range(n + 1):
+                low = max(t - s + 1, 0)
+                for w in range(bfs + 1):
+                    # opponent deploys t - u < s soldiers here: we win
+                    new_ways[t][w + 1] += prefix[t + 1][w] - prefix[low][w]
+                    # opponent deploys t - u >= s soldiers here: we lose
+                    new_ways[t][w] += prefix[low][w]
+            ways = new_ways
+
+        # A strategy wins when it takes more battlefields than it loses
+        n_wins = sum(ways[n][w] for w in range(B + 1) if w > B - w)
+        self.win_counts[key] = n_wins
+        return n_wins
+
     def get_strategy_score(self,
                            pl_strategy):
         # Calculates wins / losses that a strategy achieves
         # when compared against every selection in dataset
+        if self.exact_scoring:
+            return self.count_wins(pl_strategy)
         n_wins = 0
         for strategy in self.master_dataset:
             pl_strategy_score, strategy_score = self.compute_scores(pl_strategy,
@@ -149,32 +214,72 @@ class Blotto:
 
 
 class AttackerBot:
-    def __init__(self, blotto_game, n_strategies):
+    def __init__(self, blotto_game, n_strategies, max_history=100000, max_seen_bits=2**27):
         self.game = blotto_game
         # Number of learning strategies
         self.learning_strategies_count = n_strategies
-        # Dictionary of unique learning strategies
-        self.unique_learning_strategies = defaultdict(list)
+        # Generated strategies are tracked exactly with one bit per
+        # strategy, indexed by composition_rank, when the strategy space
+        # has at most max_seen_bits strategies. Otherwise a history of at
+        # most max_history strategies is kept, the oldest being forgotten
+        # first, and the unique count is only exact until then
+        self.max_history = max_history
+        self.seen_bits = None
+        self.strategy_history = OrderedDict()
+        self.history_evicted = False
+        if self.game.strategy_space_size <= max_seen_bits:
+            self.seen_bits = bytearray((self.game.strategy_space_size + 7) // 8)
         self.unique_strategies_count = 0
+        # Per-epoch statistics and the reason training stopped
+        self.epoch_stats = []
+        self.top_k_strategies = None
+        self.stop_reason = None
+        self.ranked_strategies = []
         # Initialise strategies for players randomly
         self.player_strategies = []
         self.create_learning_strategy_space()
 
+    def register_strategy(self, strategy):
+        # Records a strategy as generated, returns False if it has
+        # been generated before
+        if self.seen_bits is not None:
+            byte, bit = divmod(composition_rank(strategy), 8)
+            if self.seen_bits[byte] >> bit & 1:
+                return False
+            self.seen_bits[byte] |= 1 << bit
+        else:
+            key = tuple(strategy)
+            if key in self.strategy_history:
+                return False
+            self.strategy_history[key] = None
+            if len(self.strategy_history) > self.max_history:
+                self.strategy_history.popitem(last=False)
+                self.history_evicted = True
+        self.unique_strategies_count += 1
+        return True
+
+    def new_random_strategy(self, population):
+        # Create a random strategy that has not been generated before
+        # and is not in the given population
+        while True:
+            strategy = create_strategy(self.game.n_soldiers,
+                                       self.game.n_battlefields)
+            assert sum(strategy) == self.game.n_soldiers
+            if tuple(strategy) not in population and self.register_strategy(strategy):
+                return strategy
+
     def create_learning_strategy_space(self):
-        # Keep going until we put n_strategies in strategy set
-        while len(self.player_strategies) < self.learning_strategies_count:
-            strategy = create_unique_strategy(self.game.n_soldiers,
-                                              self.game.n_battlefields,
-                                              self.unique_learning_strategies)
-            self.player_strategies.append(strategy)
+        # Fill the population with random strategies, fewer if the
+        # strategy space is smaller than the population
+        self.add_strategies(self.learning_strategies_count)
 
     def mutate(self, strategy):
         # Mutate the given strategy slightly
         deploy_strategy = list(strategy)
         # Pick a a number in [1,..,n_bfs] for number of mutations
-        n_mutations = random.randrange(self.game.n_battlefields)
+        n_mutations = random.randint(1, self.game.n_battlefields)
 
-        for i in range(n_mutations - 1):
+        for i in range(n_mutations):
             # Decrement deployment in one battlefield and increment another
             rand_idx_1 = random.randrange(self.game.n_battlefields)
             rand_idx_2 = random.randrange(self.game.n_battlefields)
@@ -186,14 +291,17 @@ class AttackerBot:
         return deploy_strategy
 
     def add_strategies(self, n_strategies):
-        # Empty list for storing list of strategies
-        l_strategies = []
-        # Keep going until we put n_strategies in strategy set
-        while len(l_strategies) < n_strategies:
-            strategy = create_unique_strategy(self.game.n_soldiers,
-                                              self.game.n_battlefields,
-                                              self.unique_learning_strategies)
-            l_strategies.append(strategy)
+        # Add up to n_strategies new random strategies to the population,
+        # no more than can still be generated so that this always ends
+        population = set(tuple(stg) for stg in self.player_strategies)
+        n_unseen = self.get_unseen_count()
+        if n_unseen is None:
+            # Strategies in neither the population nor the history
+            # is a lower bound on the ones that can be generated
+            n_unseen = max(self.game.strategy_space_size - len(population) - len(self.strategy_history), 0)
+        for i in range(min(n_strategies, n_unseen)):
+            strategy = self.new_random_strategy(population)
+            population.add(tuple(strategy))
             self.player_strategies.append(strategy)
 
     def get_scored_strategies(self):
@@ -202,10 +310,16 @@ class AttackerBot:
         return sorted(strategy_scores, key=lambda strategy_score: strategy_score[1], reverse=True)
 
     def get_strategies_count(self):
-        strategies_count = 0
-        for key, value in self.unique_learning_strategies.items():
-            strategies_count += len(value)
-        return strategies_count
+        # Number of unique strategies generated so far. Once the capped
+        # history has forgotten strategies, they can be counted again
+        return self.unique_strategies_count
+
+    def get_unseen_count(self):
+        # Number of strategies never generated, None once the capped
+        # history has forgotten strategies and the count is not exact
+        if self.history_evicted:
+            return None
+        return max(self.game.strategy_space_size - self.get_strategies_count(), 0)
 
     def attack_add_update(self):
         # Creates the next generation of strategies from the current one
@@ -222,30 +336,106 @@ class AttackerBot:
             l_sorted_strategies.append(stg[0])
 
         # Populate a new generation of strategies
-        self.player_strategies = []
+        # The population is smaller than learning_strategies_count when
+        # the strategy space is
+        count = min(self.learning_strategies_count // 3, len(l_sorted_strategies))
 
-        attacker_strategies_count = self.get_strategies_count()
-        total_strategies_count = self.game.strategy_space_size
-        count = self.learning_strategies_count // 3
-        if (total_strategies_count - attacker_strategies_count) < 2 * count:
-            mutant_count = (total_strategies_count - attacker_strategies_count) // 2
-            add_count = total_strategies_count - attacker_strategies_count
-            count = self.learning_strategies_count - add_count
-        else:
-            mutant_count = count
-            add_count = 2 * count
+        # Keep the top 33% player strategies from the rankings
+        self.player_strategies = l_sorted_strategies[:count]
+        population = set(tuple(stg) for stg in self.player_strategies)
 
-        for i in range(count):
-            # Keep the top 33% player strategies from the rankings
-            self.player_strategies.append(ranked_strategies[i][0])
-        for k in range(mutant_count):
+        for k in range(count):
             # Create a mutant of the top 33% player strategies
-            mutant_strategy = self.mutate(ranked_strategies[k][0])
+            mutant_strategy = self.mutate(l_sorted_strategies[k])
+            if tuple(mutant_strategy) not in population:
+                self.register_strategy(mutant_strategy)
+                population.add(tuple(mutant_strategy))
+                self.player_strategies.append(mutant_strategy)
+
         # Add some additional random strategies, for variety in the next generation
-        self.add_strategies(add_count)
+        self.add_strategies(self.learning_strategies_count - len(self.player_strategies))
+        population = set(tuple(stg) for stg in self.player_strategies)
+
+        # Top up with the next best strategies once the strategy space runs out
+        for stg in l_sorted_strategies[count:]:
+            if len(self.player_strategies) >= self.learning_strategies_count:
+                break
+            if tuple(stg) not in population:
+                population.add(tuple(stg))
+                self.player_strategies.append(stg)
+
+        self.ranked_strategies = ranked_strategies
 
         return l_sorted_strategies
 
+    def record_epoch_stats(self, epoch, ranked_strategies, top_k, start_time):
+        # Record the statistics of a ranked generation. Only the top_k
+        # strategies of the latest generation are kept, for the
+        # stability check in train
+        top_k_scores = [stg[1] for stg in ranked_strategies[:top_k]]
+        top_k_strategies = set(tuple(stg[0]) for stg in ranked_strategies[:top_k])
+        stats = {'epoch': epoch,
+                 'best_score': top_k_scores[0],
+                 'mean_top_k_score': sum(top_k_scores) / len(top_k_scores),
+                 'top_k_stable': top_k_strategies == self.top_k_strategies,
+                 'n_unique': self.get_strategies_count(),
+                 'elapsed': time.time() - start_time}
+        self.top_k_strategies = top_k_strategies
+        self.epoch_stats.append(stats)
+        return stats
+
+    def train(self,
+              max_epochs=1000,
+              top_k=10,
+              patience=None,
+              plateau_patience=None,
+              plateau_tol=0,
+              time_budget=None,
+              log_every=100):
+        # Evolve the strategies until one of the stopping criteria is met:
+        #   max_epochs       : number of epochs run
+        #   patience         : top_k strategies unchanged for this many epochs
+        #   plateau_patience : mean top_k score improved by no more than
+        #                      plateau_tol over this many epochs
+        #   time_budget      : seconds spent training
+        # or the strategy space has been exhausted. Returns the final
+        # strategies ranked by score
+        start_time = time.time()
+        self.epoch_stats = []
+        self.top_k_strategies = None
+        self.stop_reason = "max_epochs"
+        n_top_k_stable = 0
+
+        for epoch in range(max_epochs):
+            if self.get_unseen_count() == 0:
+                self.stop_reason = "exhausted"
+                break
+
+            self.attack_add_update()
+            stats = self.record_epoch_stats(epoch, self.ranked_strategies, top_k, start_time)
+
+            if log_every and epoch % log_every == 0:
+                print("epoch:", epoch, "best score:", stats['best_score'],
+                      "attacker:", stats['n_unique'], "total:", self.game.strategy_space_size)
+
+            if stats['top_k_stable']:
+                n_top_k_stable += 1
+            else:
+                n_top_k_stable = 0
+
+            if patience is not None and n_top_k_stable >= patience:
+                self.stop_reason = "top_k_stable"
+                break
+            if plateau_patience is not None and len(self.epoch_stats) > plateau_patience:
+                past_stats = self.epoch_stats[-1 - plateau_patience]
+                if stats['mean_top_k_score'] - past_stats['mean_top_k_score'] <= plateau_tol:
+                    self.stop_reason = "plateau"
+                    break
+            if time_budget is not None and stats['elapsed'] >= time_budget:
+                self.stop_reason = "time_budget"
+                break
+
+        return self.attack()
 
     def attack(self):
         ranked_strategies = self.get_scored_strategies()
@@ -256,36 +446,30 @@ class AttackerBot:
 
 
 
-print("Input the Number of Soldiers")
-inp_n_soldiers = input("[User]: ")
-print("Input the Number of Battlefronts")
-inp_n_battlefronts = input("[User]: ")
-
-# Instantiate Game and Bot
-print("Creating Blotto Object ...\n")
-blotto_game = Blotto(inp_n_soldiers, inp_n_battlefronts)
-n_total_strategies = blotto_game.strategy_space_size
-l_strategy_space = blotto_game.create_complete_strategy_space()
+if __name__ == "__main__":
+    print("Input the Number of Soldiers")
+    inp_n_soldiers = input("[User]: ")
+    print("Input the Number of Battlefronts")
+    inp_n_battlefronts = input("[User]: ")
 
-print("\nCreating AttackerBot Object")
-n_learning_strategies = 60
-attacker_bot = AttackerBot(blotto_game, n_learning_strategies)
-
-l_final_strategies = []
-epochs = 1000
-for j in range(epochs):
-    if j % 100 == 0:
-        print("attacker:", attacker_bot.get_strategies_count(), "total:", n_total_strategies)
-    if attacker_bot.get_strategies_count() >= n_total_strategies:
-        break
-    else:
-        attacker_bot.attack_add_update()
-l_final_strategies = attacker_bot.attack()
-print("attacker:", attacker_bot.get_strategies_count(), "total:", n_total_strategies)
+    # Instantiate Game and Bot
+    print("Creating Blotto Object ...\n")
+    blotto_game = Blotto(inp_n_soldiers, inp_n_battlefronts)
+    n_total_strategies = blotto_game.strategy_space_size
+    if not blotto_game.exact_scoring:
+        l_strategy_space = blotto_game.create_complete_strategy_space()
 
-csv_file = "best_ev_strategies_100_100_3.csv"
-with open(csv_file, "w") as output:
-    writer = csv.writer(output, lineterminator='\n')
-    writer.writerows(l_final_strategies)
+    print("\nCreating AttackerBot Object")
+    n_learning_strategies = 60
+    attacker_bot = AttackerBot(blotto_game, n_learning_strategies)
 
+    l_final_strategies = attacker_bot.train(max_epochs=1000,
+                                           top_k=10,
+                                           patience=100)
+    print("attacker:", attacker_bot.get_strategies_count(), "total:", n_total_strategies)
+    print("Stopped after {} epochs: {}".format(len(attacker_bot.epoch_stats), attacker_bot.stop_reason))
 
+    csv_file = "best_ev_strategies_100_100_3.csv"
+    with open(csv_file, "w") as output:
+        writer = csv.writer(output, lineterminator='\n')
+        writer.writerows(l_final_strategies)
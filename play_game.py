@@ -1,4 +1,7 @@
 import csv
+import numpy as np
+
+from BlottoLP import BlottoLP
 
 
 def compute_scores(n_battlefields,
@@ -36,56 +39,178 @@ def get_strategy_score(n_battlefields,
     return n_wins
 
 
-csv_file_1 = "best_ev_strategies_100_100_3.csv"
-csv_file_2 = "best_lp_strategies_100_100_3.csv"
-
-with open(csv_file_1, "r") as f1:
-    ev_strategies_list = [list(map(int, rec)) for rec in csv.reader(f1, delimiter=',')]
-
-with open(csv_file_2, "r") as f2:
-    lp_strategies_list = [list(map(int, rec)) for rec in csv.reader(f2, delimiter=',')]
-
-# Evolutionary strategies List -- Attacker
-# LP Defender Strategies List -- Defender
-# Playing Round Robin against each other
-n_bfs = 3
-scored_strategy_list = []
-winning_strategy_list = []
-
-print("Attacker: Evolutionary Strategies")
-print("Defender: LP Strategies")
-print("Total No Of Battles: 60")
-print("=================================")
-for a_strategy in ev_strategies_list:
-    a_score = get_strategy_score(n_bfs,
-                                 a_strategy,
-                                 lp_strategies_list)
-    if a_score > 30:
-        scored_strategy_list.append((a_strategy, a_score))
-
-winning_strategy_list = sorted(scored_strategy_list,
-                               key=lambda strategy_score: strategy_score[1],
-                               reverse=True)
-for stg in winning_strategy_list:
-    print("Strategy:", stg[0], "No Of Battles Won:", stg[1])
-print("Total War Wins:", len(winning_strategy_list))
-
-scored_strategy_list = []
-winning_strategy_list = []
-print("\nAttacker: LP Strategies")
-print("Defender: Evolutionary Strategies")
-print("Total No Of Battles: 60")
-print("=================================")
-for a_strategy in lp_strategies_list:
-    a_score = get_strategy_score(n_bfs,
-                                 a_strategy,
-                                 ev_strategies_list)
-    if a_score > 30:
-        scored_strategy_list.append((a_strategy, a_score))
-
-winning_strategy_list = sorted(scored_strategy_list,
-                               key=lambda strategy_score: strategy_score[1],
-                               reverse=True)
-for stg in winning_strategy_list:
-    print("Strategy:", stg[0], "No Of Battles Won:", stg[1])
-print("Total War Wins:", len(winning_strategy_list))
\ No newline at end of file
+def load_strategies(csv_file):
+    # Reads a strategy set from a csv file. Plain rows of troop counts
+    # are read as they are, the header row and the "Strategy i" labels
+    # written by BlottoLP.save_bestNstrats2csv are skipped
+    strategies = []
+    with open(csv_file, "r") as f:
+        for rec in csv.reader(f, delimiter=','):
+            row = [int(v) for v in rec if v.strip().isdigit()]
+            if row:
+                strategies.append(row)
+    return strategies
+
+
+def enumerate_allocations(n_soldiers,
+                          n_battlefields,
+                          ordered=True):
+    # Lists every allocation of n_soldiers over n_battlefields as the
+    # rows of an array.
+    # ordered=True  : compositions, as played by Blotto
+    # ordered=False : partitions sorted in descending order, as in BlottoLP
+    if not ordered:
+        return BlottoLP.partition_space(n_soldiers, n_battlefields)
+
+    # Deploy to one battlefield at a time
+    allocations = np.zeros((1, 0), dtype="int64")
+    reserves = np.array([n_soldiers], dtype="int64")
+    for i in range(n_battlefields - 1):
+        counts = reserves + 1
+        rows = np.repeat(np.arange(len(reserves)), counts)
+        deploy = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        allocations = np.hstack([allocations[rows], deploy[:, None]])
+        reserves = reserves[rows] - deploy
+    # Add any remaining reserves at the last
+    return np.hstack([allocations, reserves[:, None]])
+
+
+def payoff_matrix(n_battlefields,
+                  attacker_strategies,
+                  defender_strategies,
+                  game="blotto"):
+    # Attacker payoffs of every attacker strategy against every defender
+    # strategy.
+    # game="blotto" : 1 if the attacker wins more battlefields than the
+    #                 defender under compute_scores, 0 otherwise
+    # game="lp"     : battlefields won with the troop counts matched up
+    #                 at random, see BlottoLP.payoff_matrix
+    if game == "lp":
+        return BlottoLP.payoff_matrix(attacker_strategies, defender_strategies, n_battlefields)
+
+    a_stg = np.asarray(attacker_strategies)[:, None, :]
+    d_stg = np.asarray(defender_strategies)[None, :, :]
+    attacker_score = (a_stg > d_stg).sum(axis=2)
+    return (attacker_score > n_battlefields - attacker_score).astype("float")
+
+
+def exploitability(n_battlefields,
+                   strategies,
+                   n_opponent_soldiers,
+                   probs=None,
+                   player="attacker",
+                   game="blotto",
+                   chunk_size=2**22,
+                   tol=1e-9):
+    # Evaluates a mixed strategy against a best-responding opponent
+    # over the opponent's complete strategy space.
+    #
+    # strategies: a csv file or a list / array of allocations, played
+    #             with probabilities probs (uniform if not given)
+    # player:     the side that plays the mixed strategy
+    #
+    # Returns the attacker payoff when the opponent best responds (the
+    # least the mix guarantees as attacker, the most it concedes as
+    # defender) and the opponent's best-response allocations
+    if isinstance(strategies, str):
+        strategies = load_strategies(strategies)
+    strategies = np.asarray(strategies, dtype="int64")
+    if probs is None:
+        probs = np.ones(len(strategies)) / len(strategies)
+    else:
+        probs = np.asarray(probs, dtype="float")
+        probs = probs / probs.sum()
+
+    # Only strategies that are actually played affect the payoffs
+    strategies = strategies[probs > 0]
+    probs = probs[probs > 0]
+
+    responses = enumerate_allocations(n_opponent_soldiers,
+                                      n_battlefields,
+                                      ordered=(game == "blotto"))
+    n_rows = max(1, chunk_size // (len(strategies) * n_battlefields * n_battlefields))
+
+    payoffs = np.zeros(len(responses))
+    for start in range(0, len(responses), n_rows):
+        chunk = responses[start:start + n_rows]
+        if player == "attacker":
+            payoffs[start:start + n_rows] = payoff_matrix(n_battlefields, strategies, chunk, game).T @ probs
+        else:
+            payoffs[start:start + n_rows] = payoff_matrix(n_battlefields, chunk, strategies, game) @ probs
+
+    if player == "attacker":
+        value = payoffs.min()
+        best_responses = responses[payoffs <= value + tol]
+    else:
+        value = payoffs.max()
+        best_responses = responses[payoffs >= value - tol]
+
+    return value, best_responses
+
+
+if __name__ == "__main__":
+    csv_file_1 = "best_ev_strategies_100_100_3.csv"
+    csv_file_2 = "best_lp_strategies_100_100_3.csv"
+
+    ev_strategies_list = load_strategies(csv_file_1)
+    lp_strategies_list = load_strategies(csv_file_2)
+
+    # Evolutionary strategies List -- Attacker
+    # LP Defender Strategies List -- Defender
+    # Playing Round Robin against each other
+    n_bfs = 3
+    scored_strategy_list = []
+    winning_strategy_list = []
+
+    print("Attacker: Evolutionary Strategies")
+    print("Defender: LP Strategies")
+    print("Total No Of Battles: 60")
+    print("=================================")
+    for a_strategy in ev_strategies_list:
+        a_score = get_strategy_score(n_bfs,
+                                     a_strategy,
+                                     lp_strategies_list)
+        if a_score > 30:
+            scored_strategy_list.append((a_strategy, a_score))
+
+    winning_strategy_list = sorted(scored_strategy_list,
+                                   key=lambda strategy_score: strategy_score[1],
+                                   reverse=True)
+    for stg in winning_strategy_list:
+        print("Strategy:", stg[0], "No Of Battles Won:", stg[1])
+    print("Total War Wins:", len(winning_strategy_list))
+
+    scored_strategy_list = []
+    winning_strategy_list = []
+    print("\nAttacker: LP Strategies")
+    print("Defender: Evolutionary Strategies")
+    print("Total No Of Battles: 60")
+    print("=================================")
+    for a_strategy in lp_strategies_list:
+        a_score = get_strategy_score(n_bfs,
+                                     a_strategy,
+                                     ev_strategies_list)
+        if a_score > 30:
+            scored_strategy_list.append((a_strategy, a_score))
+
+    winning_strategy_list = sorted(scored_strategy_list,
+                                   key=lambda strategy_score: strategy_score[1],
+                                   reverse=True)
+    for stg in winning_strategy_list:
+        print("Strategy:", stg[0], "No Of Battles Won:", stg[1])
+    print("Total War Wins:", len(winning_strategy_list))
+
+    # Exploitability of each strategy set played as a uniform mix
+    n_soldiers = 100
+    for name, strategies_list in [("Evolutionary", ev_strategies_list),
+                                  ("LP", lp_strategies_list)]:
+        print("\n{} Strategies: Exploitability".format(name))
+        print("=================================")
+        value, best_responses = exploitability(n_bfs, strategies_list, n_soldiers,
+                                               player="attacker")
+        print("As Attacker: Win Probability vs Best Defender:", value)
+        print("Best Defender Responses:", len(best_responses), "e.g.", best_responses[0].tolist())
+        value, best_responses = exploitability(n_bfs, strategies_list, n_soldiers,
+                                               player="defender")
+        print("As Defender: Loss Probability vs Best Attacker:", value)
+        print("Best Attacker Responses:", len(best_responses), "e.g.", best_responses[0].tolist())